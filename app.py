@@ -1,8 +1,13 @@
 import streamlit as st
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 import boto3
 import PyPDF2
 import io
 import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from tavily import TavilyClient
 from pptx import Presentation
@@ -24,14 +29,333 @@ def init_bedrock_client():
         st.error(f"AWS Bedrock接続エラー: {e}")
         return None
 
+# Bedrockで使用するモデル
+SONNET_MODEL_ID = "us.anthropic.claude-sonnet-4-20250514-v1:0"  # Sonnet 4
+REVIEW_MAX_TOKENS = 4000
+KEYWORD_MAX_TOKENS = 4096
+
+# モデルごとのコンテキスト長と入力処理速度（初回トークンまでの時間の見積もりに使用）
+MODEL_TOKEN_LIMITS = {
+    SONNET_MODEL_ID: {
+        "context_tokens": 200000,
+        "prefill_tokens_per_second": 5000,
+    }
+}
+
+# 初回トークンまでの目標時間（秒）
+REVIEW_LATENCY_TARGET_SECONDS = 3.0
+KEYWORD_LATENCY_TARGET_SECONDS = 0.5
+
+# プロンプト内の各セクションへの予算配分（上の段から優先して確保し、同じ段の中では重みで按分）
+PROMPT_BUDGET_TIERS = [
+    {"rubric": 1},
+    {"additional": 1},
+    {"document": 3, "search": 1},
+]
+
+# 複数ファイルの抽出・レビューを並行実行する際の最大スレッド数
+MAX_PARALLEL_WORKERS = 4
+
+# 複数ファイルのレビュー方法
+REVIEW_MODE_MERGED = "まとめて1件のレビュー"
+REVIEW_MODE_PER_FILE = "ファイルごとに並行レビュー"
+
+# PowerPoint出力時の1スライドあたりの最大文字数（表示領域の制約のため文字数で制限）
+SLIDE_CONTENT_MAX_CHARS = 800
+
+# モデルごとの1分あたりの上限（アカウントのクォータより少し低めに設定する）
+# secrets.tomlの[bedrock_limits.<モデルID>]で上書き可能
+DEFAULT_BEDROCK_RATE_LIMITS = {
+    SONNET_MODEL_ID: {
+        "requests_per_minute": 50,
+        "input_tokens_per_minute": 200000,
+        "output_tokens_per_minute": 40000,
+    }
+}
+
+def estimate_tokens(text):
+    """テキストのトークン数を概算（日本語は1文字≒1トークン、英数字は4文字≒1トークン）"""
+    if not text:
+        return 0
+    ascii_chars = sum(1 for ch in text if ord(ch) < 128)
+    return (len(text) - ascii_chars) + (ascii_chars + 3) // 4
+
+def truncate_to_tokens(text, max_tokens, suffix="...(省略)"):
+    """推定トークン数がmax_tokens以内になるようにテキストを切り詰め（省略記号を含めて予算内に収める）"""
+    if not text or estimate_tokens(text) <= max_tokens:
+        return text
+    limit = max_tokens - estimate_tokens(suffix)
+    if limit <= 0:
+        return ""
+    ascii_chars = 0
+    non_ascii_chars = 0
+    for i, ch in enumerate(text):
+        if ord(ch) < 128:
+            ascii_chars += 1
+        else:
+            non_ascii_chars += 1
+        if non_ascii_chars + (ascii_chars + 3) // 4 > limit:
+            return text[:i] + suffix
+    return text
+
+def allocate_token_budget(budget, demands, weights):
+    """重みに応じて予算を按分（必要量を満たしたセクションの余りは他のセクションに再配分）"""
+    allocation = {name: 0 for name in demands}
+    remaining = budget
+    active = [name for name in demands if demands[name] > 0]
+    
+    while active and remaining > 0:
+        total_weight = sum(weights[name] for name in active)
+        saturated = [
+            name for name in active
+            if demands[name] - allocation[name] <= remaining * weights[name] / total_weight
+        ]
+        
+        if not saturated:
+            # 全セクションが予算を使い切るので、端数も含めて配り切る
+            shares = {name: remaining * weights[name] // total_weight for name in active}
+            leftover = remaining - sum(shares.values())
+            for i, name in enumerate(active):
+                allocation[name] += shares[name] + (1 if i < leftover else 0)
+            remaining = 0
+            break
+        
+        for name in saturated:
+            remaining -= demands[name] - allocation[name]
+            allocation[name] = demands[name]
+        active = [name for name in active if name not in saturated]
+    
+    return allocation
+
+def plan_prompt_budget(model_id, max_output_tokens, latency_target_seconds, demands):
+    """モデルのコンテキスト長と目標レイテンシから入力トークン予算を決め、各セクションに配分"""
+    limits = MODEL_TOKEN_LIMITS.get(model_id, MODEL_TOKEN_LIMITS[SONNET_MODEL_ID])
+    input_budget = min(
+        limits["context_tokens"] - max_output_tokens,
+        int(latency_target_seconds * limits["prefill_tokens_per_second"])
+    )
+    
+    allocation = {}
+    remaining = input_budget
+    for tier in PROMPT_BUDGET_TIERS:
+        tier_demands = {name: demands.get(name, 0) for name in tier}
+        tier_allocation = allocate_token_budget(remaining, tier_demands, tier)
+        allocation.update(tier_allocation)
+        remaining -= sum(tier_allocation.values())
+    
+    return allocation
+
+class TokenBucket:
+    """1分あたりの上限を表すトークンバケット（前借りした分はマイナス残高として待ち時間に反映）"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.refill_per_second = self.capacity / 60.0
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def _refill(self, now):
+        elapsed = now - self.updated_at
+        self.tokens = min(self.capacity, self.tokens + elapsed * self.refill_per_second)
+        self.updated_at = now
+
+    def _charge(self, amount):
+        # バケット容量を超える要求は容量分として扱う（永久に待たないように）
+        return min(float(amount), self.capacity)
+
+    def reserve(self, amount, now):
+        """指定量を予約し、利用可能になるまでの待ち秒数を返す"""
+        self._refill(now)
+        self.tokens -= self._charge(amount)
+        if self.tokens >= 0:
+            return 0.0
+        return -self.tokens / self.refill_per_second
+
+    def settle(self, reserved_amount, actual_amount, now):
+        """予約時に実際に差し引いた量と実績の差分を返却（実績が多い場合は追加で消費）"""
+        self._refill(now)
+        self.tokens = min(self.capacity, self.tokens + self._charge(reserved_amount) - actual_amount)
+
+class BedrockRateLimiter:
+    """プロセス全体で共有するBedrock呼び出しのレート制限（モデルごとにRPM・入力TPM・出力TPMを管理）"""
+
+    def __init__(self, limits):
+        self.limits = limits
+        self._lock = threading.Lock()
+        self._buckets = {}
+
+    def _get_buckets(self, model_id):
+        if model_id not in self._buckets:
+            limit = self.limits.get(model_id, DEFAULT_BEDROCK_RATE_LIMITS[SONNET_MODEL_ID])
+            self._buckets[model_id] = {
+                "requests": TokenBucket(limit["requests_per_minute"]),
+                "input_tokens": TokenBucket(limit["input_tokens_per_minute"]),
+                "output_tokens": TokenBucket(limit["output_tokens_per_minute"]),
+            }
+        return self._buckets[model_id]
+
+    def reserve(self, model_id, input_tokens, output_tokens):
+        """枠を予約し、呼び出し可能になるまでの待ち秒数を返す（予約順に順番待ちとなる）"""
+        with self._lock:
+            now = time.monotonic()
+            buckets = self._get_buckets(model_id)
+            return max(
+                buckets["requests"].reserve(1, now),
+                buckets["input_tokens"].reserve(input_tokens, now),
+                buckets["output_tokens"].reserve(output_tokens, now),
+            )
+
+    def settle(self, model_id, estimated_input, estimated_output, usage):
+        """レスポンスの実績トークン数で予約量を補正"""
+        if not usage:
+            return
+        with self._lock:
+            now = time.monotonic()
+            buckets = self._get_buckets(model_id)
+            buckets["input_tokens"].settle(estimated_input, usage.get("inputTokens", estimated_input), now)
+            buckets["output_tokens"].settle(estimated_output, usage.get("outputTokens", estimated_output), now)
+
+@st.cache_resource
+def get_bedrock_rate_limiter():
+    """全セッションで共有するレートリミッターを取得"""
+    limits = {model_id: dict(limit) for model_id, limit in DEFAULT_BEDROCK_RATE_LIMITS.items()}
+    try:
+        for model_id, overrides in st.secrets.get("bedrock_limits", {}).items():
+            limits.setdefault(model_id, dict(DEFAULT_BEDROCK_RATE_LIMITS[SONNET_MODEL_ID])).update(overrides)
+    except Exception:
+        # secrets.tomlが無い場合はデフォルト値を使用
+        pass
+    return BedrockRateLimiter(limits)
+
+def wait_for_bedrock_capacity(model_id, input_tokens, output_tokens, wait_placeholder=None):
+    """レート制限の枠が空くまで待機（待ち時間の目安を画面に表示、ワーカースレッドからは表示先を指定する）"""
+    wait_seconds = get_bedrock_rate_limiter().reserve(model_id, input_tokens, output_tokens)
+    if wait_seconds <= 0:
+        return
+    
+    wait_placeholder = wait_placeholder or st.empty()
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        wait_placeholder.info(f"⏳ 利用者が集中しているため順番待ちしています（残り約{int(remaining) + 1}秒）")
+        time.sleep(min(1.0, remaining))
+    wait_placeholder.empty()
+
+# 繰り返し行（ヘッダー・フッター等）とみなす条件
+BOILERPLATE_MIN_PAGES = 4  # これより少ないページ数の文書では判定しない
+BOILERPLATE_PAGE_RATIO = 0.8  # 全ページのうちこの割合以上に出現する行を繰り返し行とみなす
+BOILERPLATE_MIN_LENGTH = 3  # 短すぎる行（箇条書き記号など）は対象外
+
+# 表の開始を示す目印（表の行とともに繰り返し行の判定対象外）
+TABLE_MARKER = "[表]"
+
+# ページ番号の書式（例: "P.3", "Page 3", "- 3 -", "3 / 10", "3ページ", "3頁"）と数字だけの行
+PAGE_NUMBER_FORMAT_PATTERN = re.compile(
+    r'^(?:(?:page|p\.?)\s*\d{1,4}(?:\s*/\s*\d{1,4})?'
+    r'|[-‐―]\s*\d{1,4}\s*[-‐―]'
+    r'|\d{1,4}\s*/\s*\d{1,4}(?:\s*(?:ページ|頁))?'
+    r'|(?:ページ|頁)\s*\d{1,4}'
+    r'|\d{1,4}\s*(?:ページ|頁))$',
+    re.IGNORECASE
+)
+BARE_NUMBER_PATTERN = re.compile(r'^\d{1,4}$')
+
+def is_boilerplate_candidate(line):
+    """繰り返し行として冒頭にまとめてよい行か（表・数字・短い行は本文の一部として残す）"""
+    return (
+        len(line) >= BOILERPLATE_MIN_LENGTH
+        and line != TABLE_MARKER
+        and '\t' not in line
+        and not BARE_NUMBER_PATTERN.match(line)
+        and not PAGE_NUMBER_FORMAT_PATTERN.match(line)
+    )
+
+def find_page_number_lines(page_lines):
+    """各ページの先頭・末尾にあるページ番号の行を(ページ位置, 行位置)の集合で返す"""
+    page_number_lines = set()
+    bare_numbers = {}  # ページ番号とページ位置の差 -> [(ページ位置, 行位置)]
+    
+    for page_index, lines in enumerate(page_lines):
+        if not lines:
+            continue
+        for line_index in dict.fromkeys([0, len(lines) - 1]):
+            line = lines[line_index]
+            if PAGE_NUMBER_FORMAT_PATTERN.match(line):
+                page_number_lines.add((page_index, line_index))
+            elif BARE_NUMBER_PATTERN.match(line):
+                offset = int(line) - page_index
+                bare_numbers.setdefault(offset, []).append((page_index, line_index))
+    
+    # 数字だけの行は、ページ順に連番で並んでいる場合のみページ番号とみなす（金額などの数値を消さないため）
+    if bare_numbers:
+        positions = max(bare_numbers.values(), key=lambda positions: len({page for page, _ in positions}))
+        if len({page for page, _ in positions}) >= max(2, len(page_lines) * 0.5):
+            page_number_lines.update(positions)
+    
+    return page_number_lines
+
+def compact_extracted_pages(pages, page_label):
+    """ページごとの抽出テキストから繰り返し行とページ番号を除いて結合（繰り返し行は冒頭に1回だけ記載）"""
+    page_lines = []
+    for page_text in pages:
+        # タブは表の空セルの位置を保つため残す
+        lines = [re.sub(r'[ \u3000]+', ' ', line).strip(' \u3000') for line in (page_text or "").split('\n')]
+        page_lines.append([line for line in lines if line])
+    
+    # 複数ページに出現する行を集計（同一ページ内の重複は1回と数える）
+    line_page_counts = {}
+    for lines in page_lines:
+        for line in dict.fromkeys(lines):
+            line_page_counts[line] = line_page_counts.get(line, 0) + 1
+    
+    boilerplate_lines = []
+    if len(pages) >= BOILERPLATE_MIN_PAGES:
+        threshold = max(3, len(pages) * BOILERPLATE_PAGE_RATIO)
+        boilerplate_lines = [
+            line for line, count in line_page_counts.items()
+            if count >= threshold and is_boilerplate_candidate(line)
+        ]
+    boilerplate = set(boilerplate_lines)
+    
+    # 繰り返し行を除いた上で、先頭・末尾のページ番号を判定
+    page_lines = [[line for line in lines if line not in boilerplate] for lines in page_lines]
+    page_number_lines = find_page_number_lines(page_lines)
+    
+    compacted_pages = []
+    for page_index, lines in enumerate(page_lines):
+        body = [line for line_index, line in enumerate(lines) if (page_index, line_index) not in page_number_lines]
+        if body:
+            compacted_pages.append(f"[{page_label}{page_index + 1}]\n" + "\n".join(body))
+    
+    # ページ番号の記載はレビュー観点のため、行を削除した場合はその旨を残す
+    # （検出できない書式もあるため「なし」とは断定しない。サニタイズで全角の括弧や読点は除去されるため、区切りには半角記号を使う）
+    page_kind = 'スライド' if page_label == 'S' else 'ページ'
+    page_note = ". ページ番号の記載: あり" if page_number_lines else ""
+    header = [f"([{page_label}数字]は{page_kind}番号{page_note})"]
+    if boilerplate_lines:
+        header.append("[全ページ共通の記載]\n" + "\n".join(boilerplate_lines))
+    
+    return "\n".join(header) + "\n\n" + "\n\n".join(compacted_pages) + "\n"
+
+def format_table_as_tsv(table):
+    """表をタブ区切り形式に整形（先頭行をヘッダーとして1回だけ出力し、空セルも列位置を保持）"""
+    rows = []
+    for row in table.rows:
+        cells = [re.sub(r'\s+', ' ', cell.text).strip() for cell in row.cells]
+        if any(cells):
+            rows.append("\t".join(cells))
+    if not rows:
+        return ""
+    return TABLE_MARKER + "\n" + "\n".join(rows)
+
 def extract_text_from_pdf(pdf_file):
     """PDFファイルからテキストを抽出"""
     try:
         pdf_reader = PyPDF2.PdfReader(pdf_file)
-        text = ""
-        for page in pdf_reader.pages:
-            text += page.extract_text() + "\n"
-        return text
+        pages = [page.extract_text() for page in pdf_reader.pages]
+        return compact_extracted_pages(pages, "P")
     except Exception as e:
         st.error(f"PDF読み込みエラー: {e}")
         return None
@@ -44,10 +368,10 @@ def extract_text_from_pptx(pptx_file):
         
         # PowerPointファイルを読み込み
         presentation = Presentation(pptx_file)
-        text = ""
+        slides = []
         
-        for slide_num, slide in enumerate(presentation.slides, 1):
-            text += f"\n--- スライド {slide_num} ---\n"
+        for slide in presentation.slides:
+            text = ""
             
             # スライド内の全ての図形からテキストを抽出
             for shape in slide.shapes:
@@ -56,22 +380,66 @@ def extract_text_from_pptx(pptx_file):
                 
                 # 表がある場合のテキスト抽出
                 if shape.has_table:
-                    table = shape.table
-                    for row in table.rows:
-                        row_text = []
-                        for cell in row.cells:
-                            if cell.text:
-                                row_text.append(cell.text.strip())
-                        if row_text:
-                            text += " | ".join(row_text) + "\n"
+                    text += format_table_as_tsv(shape.table) + "\n"
             
-            text += "\n"
+            slides.append(text)
         
-        return text
+        return compact_extracted_pages(slides, "S")
     except Exception as e:
         st.error(f"PowerPoint読み込みエラー: {e}")
         return None
 
+@st.cache_data(show_spinner=False)
+def extract_text_from_file_contents(file_name, file_bytes):
+    """ファイル形式を判定してテキストを抽出（ファイル名と内容が同じなら再実行時は前回の結果を再利用）"""
+    file_extension = file_name.lower().split('.')[-1]
+    
+    if file_extension == 'pdf':
+        return extract_text_from_pdf(io.BytesIO(file_bytes))
+    elif file_extension == 'pptx':
+        return extract_text_from_pptx(io.BytesIO(file_bytes))
+    else:
+        st.error(f"サポートされていないファイル形式です: {file_extension}")
+        return None
+
+def extract_text_from_file(uploaded_file):
+    """アップロードされたファイルからテキストを抽出"""
+    return extract_text_from_file_contents(uploaded_file.name, uploaded_file.getvalue())
+
+def attach_script_run_ctx(ctx):
+    """ワーカースレッドからStreamlitの表示を更新できるようにセッション情報を引き継ぐ"""
+    add_script_run_ctx(threading.current_thread(), ctx)
+
+def extract_texts_in_parallel(uploaded_files):
+    """複数ファイルのテキストを並列で抽出（抽出できたファイルの(ファイル名, テキスト)をアップロード順で返す）"""
+    # PDF/PowerPointの解析はPythonで行われるためスレッドでは同時に実行されず、重なるのは入出力の待ち時間のみ
+    # 再実行時の再抽出はファイルごとのキャッシュで避ける
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_WORKERS, initializer=attach_script_run_ctx, initargs=(get_script_run_ctx(),)) as executor:
+        texts = list(executor.map(extract_text_from_file, uploaded_files))
+    return [(uploaded_file.name, text) for uploaded_file, text in zip(uploaded_files, texts) if text]
+
+def merge_documents(documents):
+    """複数ファイルのテキストを1つの決裁書として結合"""
+    if len(documents) == 1:
+        return documents[0][1]
+    return "\n\n".join(f"=== ファイル: {name} ===\n{text}" for name, text in documents)
+
+def fit_documents_to_budget(documents, max_tokens):
+    """ファイルごとに予算を按分して個別に切り詰めてから結合（先頭のファイルだけで予算を使い切らないように）"""
+    overhead = estimate_tokens(merge_documents([(name, "") for name, _ in documents]))
+    if overhead > max_tokens:
+        return ""
+    allocation = allocate_token_budget(
+        max_tokens - overhead,
+        {i: estimate_tokens(text) for i, (_, text) in enumerate(documents)},
+        {i: 1 for i in range(len(documents))}
+    )
+    return merge_documents([(name, truncate_to_tokens(text, allocation[i])) for i, (name, text) in enumerate(documents)])
+
+def file_stem(filename):
+    """ダウンロードファイル名用に拡張子を除去"""
+    return filename.replace('.pdf', '').replace('.pptx', '')
+
 def init_tavily_client():
     """Tavily APIクライアントを初期化"""
     try:
@@ -139,11 +507,26 @@ DEFAULT_REVIEW_PROMPT_TEMPLATE = """あなたは製造業の情シス部門の
 【決裁書内容】
 {document_text}"""
 
-def extract_keywords_with_sonnet(bedrock_client, document_text):
+ADDITIONAL_INSTRUCTION_TEMPLATE = """
+
+【追加のレビュー指示】
+{additional_message}
+上記の指示を特に重視してレビューを行ってください。"""
+
+def extract_keywords_with_sonnet(bedrock_client, documents):
     """Claude Sonnet 4を使用して文書から検索キーワードを抽出"""
     try:
+        budget = plan_prompt_budget(
+            SONNET_MODEL_ID,
+            KEYWORD_MAX_TOKENS,
+            KEYWORD_LATENCY_TARGET_SECONDS,
+            {
+                "rubric": estimate_tokens(KEYWORD_EXTRACTION_PROMPT_TEMPLATE.format(document_text="")),
+                "document": estimate_tokens(merge_documents(documents))
+            }
+        )
         keyword_extraction_prompt = KEYWORD_EXTRACTION_PROMPT_TEMPLATE.format(
-            document_text=document_text[:1500]
+            document_text=fit_documents_to_budget(documents, budget["document"])
         )
         
         messages = [
@@ -157,13 +540,17 @@ def extract_keywords_with_sonnet(bedrock_client, document_text):
             }
         ]
         
+        input_tokens = estimate_tokens(keyword_extraction_prompt)
+        wait_for_bedrock_capacity(SONNET_MODEL_ID, input_tokens, KEYWORD_MAX_TOKENS)
+        
         response = bedrock_client.converse(
-            modelId="us.anthropic.claude-sonnet-4-20250514-v1:0",  # Sonnet 4
+            modelId=SONNET_MODEL_ID,
             messages=messages,
             inferenceConfig={
-                "maxTokens": 4096
+                "maxTokens": KEYWORD_MAX_TOKENS
             }
         )
+        get_bedrock_rate_limiter().settle(SONNET_MODEL_ID, input_tokens, KEYWORD_MAX_TOKENS, response.get('usage'))
         
         # レスポンスから検索キーワードを抽出
         response_text = response['output']['message']['content'][0]['text']
@@ -181,15 +568,15 @@ def extract_keywords_with_sonnet(bedrock_client, document_text):
         st.warning(f"キーワード抽出エラー: {e}")
         return ["決裁書", "承認", "ガイドライン"]  # フォールバック
 
-def search_related_information(tavily_client, bedrock_client, document_text, enable_search=True):
-    """文書内容に関連する最新情報を検索"""
+def search_related_information(tavily_client, bedrock_client, documents, enable_search=True):
+    """文書内容に関連する最新情報を検索（プロンプトへの整形はformat_search_resultsで行う）"""
     if not enable_search or not tavily_client or not bedrock_client:
-        return ""
+        return []
     
     try:
         # Claude Sonnet 4でキーワード抽出
         st.info("検索キーワードを抽出中...")
-        extracted_keywords = extract_keywords_with_sonnet(bedrock_client, document_text)
+        extracted_keywords = extract_keywords_with_sonnet(bedrock_client, documents)
         
         if extracted_keywords:
             st.success(f"✅ 抽出されたキーワード: {', '.join(extracted_keywords)}")
@@ -216,23 +603,48 @@ def search_related_information(tavily_client, bedrock_client, document_text, ena
                 st.warning(f"検索キーワード '{keyword}' でエラー: {e}")
                 continue
         
-        # 検索結果をフォーマット（文字数制限付き）
-        if search_results:
-            formatted_results = "\n\n=== 関連情報（AI抽出キーワード検索結果） ===\n"
-            
-            for i, result in enumerate(search_results[:5], 1):  # 最大5件に制限
-                formatted_results += f"\n{i}. {result['title'][:80]}...\n"  # タイトルも短縮
-                formatted_results += f"内容: {result['content'][:150]}...\n"  # 内容をさらに短縮
-                formatted_results += f"出典: {result['url']}\n"
-                formatted_results += f"検索キーワード: {result['keyword']}\n"
-            
-            return formatted_results
-        else:
-            return ""
+        return search_results[:5]  # 最大5件に制限
             
     except Exception as e:
         st.warning(f"関連情報検索エラー: {e}")
+        return []
+
+# 検索結果の見出し（サニタイズで除去されない記号のみ使用）
+SEARCH_RESULTS_HEADER = "[関連情報: AI抽出キーワード検索結果]\n"
+
+def format_search_results(search_results, max_tokens=None):
+    """検索結果をテキストに整形（max_tokensを指定した場合は各結果に予算を均等に割り当てて収める）"""
+    if not search_results:
         return ""
+    
+    formatted_results = SEARCH_RESULTS_HEADER
+    remaining = None
+    if max_tokens is not None:
+        remaining = max_tokens - estimate_tokens(formatted_results)
+        if remaining <= 0:
+            return ""
+    
+    for i, result in enumerate(search_results, 1):
+        title = result['title']
+        content = result['content']
+        source = f"出典: {result['url']}\n検索キーワード: {result['keyword']}\n"
+        
+        if remaining is not None:
+            # 残り予算を残りの件数で割り、短い結果で余った分は後続の結果に回す
+            share = remaining // (len(search_results) - i + 1)
+            flexible = share - estimate_tokens(f"\n{i}. \n内容: \n{source}")
+            if flexible <= 0:
+                break
+            title_budget = min(estimate_tokens(title), flexible // 4)
+            title = truncate_to_tokens(title, title_budget)
+            content = truncate_to_tokens(content, flexible - title_budget)
+        
+        entry = f"\n{i}. {title}\n内容: {content}\n{source}"
+        formatted_results += entry
+        if remaining is not None:
+            remaining -= estimate_tokens(entry)
+    
+    return formatted_results
 
 def create_powerpoint_from_review(review_text, filename="review_result"):
     """レビュー結果からPowerPointプレゼンテーションを作成"""
@@ -287,8 +699,8 @@ def create_powerpoint_from_review(review_text, filename="review_result"):
                 content_placeholder = slide.placeholders[1]
                 
                 # 長すぎるコンテンツを調整
-                if len(content) > 800:
-                    content = content[:800] + "\n\n（以下省略）"
+                if len(content) > SLIDE_CONTENT_MAX_CHARS:
+                    content = content[:SLIDE_CONTENT_MAX_CHARS] + "\n\n（以下省略）"
                 
                 content_placeholder.text = content
                 
@@ -365,12 +777,10 @@ def sanitize_text_safe_encoding(text):
         # 英数字、日本語、基本的な句読点のみ許可
         safe_text = re.sub(r'[^\w\s\u3040-\u309F\u30A0-\u30FF\u4E00-\u9FAF\.\,\!\?\:\;\-\(\)\[\]\"\'\/]', ' ', text)
         
-        # 複数の空白を単一に
-        safe_text = re.sub(r'\s+', ' ', safe_text).strip()
-        
-        # 長すぎる場合は切り詰め
-        if len(safe_text) > 8000:
-            safe_text = safe_text[:8000] + "...(省略)"
+        # 複数の空白を単一に（改行とタブは表や行の区切りとして残す）
+        safe_text = re.sub(r'[^\S\n\t]+', ' ', safe_text)
+        safe_text = re.sub(r' *\t *', '\t', safe_text)
+        safe_text = re.sub(r' *\n[ \n]*', '\n', safe_text).strip()
         
         # ASCII互換性チェック
         try:
@@ -387,31 +797,71 @@ def sanitize_text_safe_encoding(text):
         st.warning(f"テキスト処理で問題が発生しました: {e}")
         # 最低限の文字のみ保持
         fallback_text = re.sub(r'[^\w\s]', ' ', str(text))
-        return re.sub(r'\s+', ' ', fallback_text).strip()[:5000]
+        return re.sub(r'\s+', ' ', fallback_text).strip()
+
+# 決裁書本文と検索結果の区切り
+SEARCH_CONTEXT_SEPARATOR = "\n\n"
 
-def create_review_prompt(document_text, custom_prompt_template, search_results="", additional_message=""):
-    """決裁書レビュー用のプロンプトを作成（安全なエンコーディング付き）"""
+def create_review_prompt(documents, custom_prompt_template, search_results=None, additional_message=""):
+    """決裁書レビュー用のプロンプトを作成（安全なエンコーディング・トークン予算付き、予算に収まらない場合はNone）"""
     # 新しい安全なサニタイズ方式を適用
-    document_text = sanitize_text_safe_encoding(document_text)
+    documents = [
+        (sanitize_text_safe_encoding(name), sanitize_text_safe_encoding(text))
+        for name, text in documents
+    ]
+    search_results = [
+        dict(result,
+             title=sanitize_text_safe_encoding(result['title']),
+             content=sanitize_text_safe_encoding(result['content']),
+             url=sanitize_text_safe_encoding(result['url']),
+             keyword=sanitize_text_safe_encoding(result['keyword']))
+        for result in (search_results or [])
+    ]
+    if additional_message and additional_message.strip():
+        additional_message = sanitize_text_safe_encoding(additional_message)
+    else:
+        additional_message = ""
+    
+    # 各セクションの必要量からトークン予算を配分
+    additional_wrapper_tokens = estimate_tokens(ADDITIONAL_INSTRUCTION_TEMPLATE.format(additional_message=""))
+    rubric_tokens = estimate_tokens(custom_prompt_template.format(document_text=""))
+    budget = plan_prompt_budget(
+        SONNET_MODEL_ID,
+        REVIEW_MAX_TOKENS,
+        REVIEW_LATENCY_TARGET_SECONDS,
+        {
+            "rubric": rubric_tokens,
+            "additional": additional_wrapper_tokens + estimate_tokens(additional_message) if additional_message else 0,
+            "document": estimate_tokens(merge_documents(documents)),
+            "search": estimate_tokens(SEARCH_CONTEXT_SEPARATOR + format_search_results(search_results)) if search_results else 0
+        }
+    )
+    
+    # レビュープロンプトは切り詰められないため、単体で予算を超える場合はレビューしない
+    if budget["rubric"] < rubric_tokens:
+        st.error(f"❌ レビュープロンプトが長すぎます（約{rubric_tokens}トークン、上限約{budget['rubric']}トークン）。サイドバーのプロンプトを短くしてください。")
+        return None
+    
+    enhanced_document_text = fit_documents_to_budget(documents, budget["document"])
+    # 各項目はサニタイズ済みのため、整形後の検索結果はそのまま予算内に収まる
+    search_context = format_search_results(search_results, budget["search"] - estimate_tokens(SEARCH_CONTEXT_SEPARATOR))
+    if search_context:
+        enhanced_document_text += SEARCH_CONTEXT_SEPARATOR + search_context
     
-    enhanced_document_text = document_text
-    if search_results:
-        search_results = sanitize_text_safe_encoding(search_results)
-        enhanced_document_text = document_text + search_results
+    prompt = custom_prompt_template.format(document_text=enhanced_document_text)
     
     # 追加メッセージがある場合はプロンプトに含める
-    if additional_message and additional_message.strip():
-        additional_instruction = f"\n\n【追加のレビュー指示】\n{sanitize_text_safe_encoding(additional_message)}\n上記の指示を特に重視してレビューを行ってください。"
-        prompt = custom_prompt_template.format(document_text=enhanced_document_text) + additional_instruction
-    else:
-        prompt = custom_prompt_template.format(document_text=enhanced_document_text)
+    if additional_message and budget["additional"] > additional_wrapper_tokens:
+        additional_message = truncate_to_tokens(additional_message, budget["additional"] - additional_wrapper_tokens)
+        prompt += ADDITIONAL_INSTRUCTION_TEMPLATE.format(additional_message=additional_message)
     
     return prompt
 
-def stream_bedrock_response(bedrock_client, prompt):
-    """Bedrock APIを使用してストリーミングレスポンスを生成"""
+def stream_bedrock_response(bedrock_client, prompt, message_placeholder=None):
+    """Bedrock APIを使用してストリーミングレスポンスを生成（順番待ちやエラーの表示先を指定可能）"""
+    message_container = message_placeholder or st
     try:
-        model_id = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+        model_id = SONNET_MODEL_ID
         
         messages = [
             {
@@ -424,11 +874,13 @@ def stream_bedrock_response(bedrock_client, prompt):
             }
         ]
         
+        wait_for_bedrock_capacity(model_id, estimate_tokens(prompt), REVIEW_MAX_TOKENS, message_placeholder)
+        
         response = bedrock_client.converse_stream(
             modelId=model_id,
             messages=messages,
             inferenceConfig={
-                "maxTokens": 4000
+                "maxTokens": REVIEW_MAX_TOKENS
             }
         )
         
@@ -437,14 +889,78 @@ def stream_bedrock_response(bedrock_client, prompt):
     except Exception as e:
         error_msg = str(e)
         if "ServiceUnavailableException" in error_msg:
-            st.error("🚫 Bedrock APIが一時的に利用できません。検索機能をオフにするか、より短い文書でお試しください。")
+            message_container.error("🚫 Bedrock APIが一時的に利用できません。検索機能をオフにするか、より短い文書でお試しください。")
         elif "ThrottlingException" in error_msg:
-            st.error("⏱️ APIのリクエスト制限に達しました。しばらく待ってから再試行してください。")
+            message_container.error("⏱️ APIのリクエスト制限に達しました。しばらく待ってから再試行してください。")
         elif "AccessDeniedException" in error_msg:
-            st.error("🔑 AWS認証情報またはモデルアクセス権限を確認してください。")
+            message_container.error("🔑 AWS認証情報またはモデルアクセス権限を確認してください。")
         else:
-            st.error(f"❌ Bedrock API呼び出しエラー: {e}")
+            message_container.error(f"❌ Bedrock API呼び出しエラー: {e}")
+        return None
+
+def render_review_stream(response_stream, response_container, prompt):
+    """ストリーミングレスポンスをコンテナに逐次表示し、レビュー全文を返す"""
+    full_response = ""
+    for event in response_stream['stream']:
+        if 'contentBlockDelta' in event:
+            delta = event['contentBlockDelta']['delta']
+            if 'text' in delta:
+                full_response += delta['text']
+                response_container.markdown(full_response)
+        elif 'metadata' in event:
+            # 実績トークン数でレート制限の予約量を補正
+            get_bedrock_rate_limiter().settle(
+                SONNET_MODEL_ID,
+                estimate_tokens(prompt),
+                REVIEW_MAX_TOKENS,
+                event['metadata'].get('usage')
+            )
+    return full_response
+
+def show_review_download_button(review_text, download_name, key=None):
+    """レビュー結果のPowerPointダウンロードボタンを表示"""
+    ppt_data = create_powerpoint_from_review(review_text)
+    if ppt_data:
+        st.download_button(
+            label="📊 レビュー結果をPowerPointでダウンロード",
+            data=ppt_data,
+            file_name=f"review_{download_name}.pptx",
+            mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
+            type="primary",
+            key=key
+        )
+
+def review_in_container(bedrock_client, prompt, response_container):
+    """レビューのリクエストから結果表示までを指定のコンテナ内で実行（リクエスト失敗時はNone）"""
+    response_stream = stream_bedrock_response(bedrock_client, prompt, response_container)
+    if not response_stream:
         return None
+    return render_review_stream(response_stream, response_container, prompt)
+
+def run_parallel_reviews(bedrock_client, documents, prompt_template, search_results, additional_message):
+    """ファイルごとのレビューを並行実行し、タブごとに結果を表示"""
+    tabs = st.tabs([f"📄 {name}" for name, _ in documents])
+    reviews = []
+    
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_WORKERS, initializer=attach_script_run_ctx, initargs=(get_script_run_ctx(),)) as executor:
+        # ストリームはワーカー内で開くため、同時に開く接続数はスレッド数までに収まる
+        for tab, document in zip(tabs, documents):
+            with tab:
+                prompt = create_review_prompt([document], prompt_template, search_results, additional_message)
+                if prompt:
+                    future = executor.submit(review_in_container, bedrock_client, prompt, st.empty())
+                    reviews.append((tab, document[0], future))
+        
+        for i, (tab, name, future) in enumerate(reviews):
+            with tab:
+                try:
+                    full_response = future.result()
+                    if full_response is None:
+                        continue
+                    st.success("✅ レビュー完了")
+                    show_review_download_button(full_response, file_stem(name), key=f"download_review_{i}")
+                except Exception as e:
+                    st.error(f"ストリーミング処理エラー: {e}")
 
 def check_authentication():
     """認証チェック関数"""
@@ -651,14 +1167,25 @@ def main():
         )
     
     # メインエリア    
-    uploaded_file = st.file_uploader(
+    uploaded_files = st.file_uploader(
         "決裁書をアップロードしてください",
         type=['pdf', 'pptx'],
-        help="PDFファイル(.pdf)またはPowerPointファイル(.pptx)に対応しています"
+        accept_multiple_files=True,
+        help="PDFファイル(.pdf)またはPowerPointファイル(.pptx)に対応しています。本紙と見積書・別紙などをまとめてアップロードできます"
     )
     
-    if uploaded_file is not None:
-        st.success(f"✅ ファイルアップロード完了")
+    if uploaded_files:
+        st.success(f"✅ ファイルアップロード完了（{len(uploaded_files)}件）")
+        
+        # 複数ファイルの場合はレビュー方法を選択
+        review_mode = REVIEW_MODE_MERGED
+        if len(uploaded_files) > 1:
+            review_mode = st.radio(
+                "レビュー方法",
+                [REVIEW_MODE_MERGED, REVIEW_MODE_PER_FILE],
+                horizontal=True,
+                help="まとめてレビューすると全ファイルを1つの決裁書として扱います。ファイルごとのレビューは並行して実行されます"
+            )
         
         # 追加のメッセージ入力フォーム
         st.markdown("### 📝 追加のレビュー指示（任意）")
@@ -671,76 +1198,57 @@ def main():
             label_visibility="collapsed"
         )
         
-        # ファイル形式を判定してテキスト抽出
-        file_extension = uploaded_file.name.lower().split('.')[-1]
+        # 全ファイルのテキストを並列で抽出
+        with st.spinner("ファイル内容を読み込み中..."):
+            documents = extract_texts_in_parallel(uploaded_files)
         
-        if file_extension == 'pdf':
-            with st.spinner("PDF内容を読み込み中..."):
-                document_text = extract_text_from_pdf(uploaded_file)
-        elif file_extension == 'pptx':
-            with st.spinner("PowerPoint内容を読み込み中..."):
-                document_text = extract_text_from_pptx(uploaded_file)
-        else:
-            st.error(f"サポートされていないファイル形式です: {file_extension}")
-            document_text = None
-        
-        if document_text:            
+        if documents:            
             # レビュー実行ボタン
             if st.button("🔍 AIレビューを開始", type="primary"):
                 bedrock_client = init_bedrock_client()
                 
                 if bedrock_client:
-                    search_results = ""
+                    search_results = []
                     
-                    # 関連情報検索（有効な場合）
+                    # 関連情報検索（有効な場合、全ファイル共通で1回だけ実行）
                     if enable_search:
                         with st.spinner("関連情報を検索中..."):
                             tavily_client = init_tavily_client()
                             if tavily_client:
-                                search_results = search_related_information(tavily_client, bedrock_client, document_text, enable_search)
+                                search_results = search_related_information(tavily_client, bedrock_client, documents, enable_search)
                                 if search_results:
                                     st.success("✅ 関連情報の検索完了")
                                     with st.expander("🔎 検索された関連情報"):
-                                        st.markdown(search_results)
+                                        st.markdown(format_search_results(search_results))
                                 else:
                                     st.info("ℹ️ 追加の関連情報は見つかりませんでした")
                     
-                    # プロンプト作成
-                    prompt = create_review_prompt(document_text, st.session_state.get('custom_prompt', ''), search_results, additional_message)
-                    
-                    # ストリーミングレスポンス表示
-                    with st.spinner("AIレビューを実行中..."):
-                        response_stream = stream_bedrock_response(bedrock_client, prompt)
+                    if review_mode == REVIEW_MODE_PER_FILE:
+                        with st.spinner("ファイルごとのAIレビューを並行実行中..."):
+                            run_parallel_reviews(bedrock_client, documents, st.session_state.get('custom_prompt', ''), search_results, additional_message)
+                    else:
+                        # プロンプト作成
+                        prompt = create_review_prompt(documents, st.session_state.get('custom_prompt', ''), search_results, additional_message)
                         
-                        if response_stream:
-                            # ストリーミング結果を表示するコンテナ
-                            response_container = st.empty()
-                            full_response = ""
+                        # ストリーミングレスポンス表示
+                        with st.spinner("AIレビューを実行中..."):
+                            response_stream = stream_bedrock_response(bedrock_client, prompt) if prompt else None
                             
-                            try:
-                                for event in response_stream['stream']:
-                                    if 'contentBlockDelta' in event:
-                                        delta = event['contentBlockDelta']['delta']
-                                        if 'text' in delta:
-                                            full_response += delta['text']
-                                            response_container.markdown(full_response)
-                                
-                                # 最終結果の保存オプション
-                                st.success("✅ レビュー完了")
-                                
-                                # PowerPointダウンロードボタン
-                                ppt_data = create_powerpoint_from_review(full_response)
-                                if ppt_data:
-                                    st.download_button(
-                                        label="📊 レビュー結果をPowerPointでダウンロード",
-                                        data=ppt_data,
-                                        file_name=f"review_{uploaded_file.name.replace('.pdf', '').replace('.pptx', '')}.pptx",
-                                        mime="application/vnd.openxmlformats-officedocument.presentationml.presentation",
-                                        type="primary"
-                                    )
-                                
-                            except Exception as e:
-                                st.error(f"ストリーミング処理エラー: {e}")
+                            if response_stream:
+                                try:
+                                    # ストリーミング結果を表示するコンテナ
+                                    full_response = render_review_stream(response_stream, st.empty(), prompt)
+                                    
+                                    # 最終結果の保存オプション
+                                    st.success("✅ レビュー完了")
+                                    
+                                    download_name = file_stem(documents[0][0])
+                                    if len(documents) > 1:
+                                        download_name += f"_ほか{len(documents) - 1}件"
+                                    show_review_download_button(full_response, download_name)
+                                    
+                                except Exception as e:
+                                    st.error(f"ストリーミング処理エラー: {e}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file